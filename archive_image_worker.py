@@ -0,0 +1,62 @@
+from functools import partial
+from image_worker import ImageWorker
+from PIL import Image
+import tarfile
+from typing import Callable, Iterator, List, Tuple
+import zipfile
+
+archive_types = [".zip", ".tar", ".tar.gz", ".tgz"]
+# Separates the archive name from the member name in the name of an archived image, e.g. photos.zip!2019/img.jpg
+archive_separator = "!"
+
+
+# Determine if the given file is an archive which can be searched for images
+def is_archive(file: str) -> bool:
+    return any(file.lower().endswith(archive_type) for archive_type in archive_types)
+
+
+# Get the archive name of an archived image's name (see archive_separator), or None if the name isn't archived
+def get_archive_name(name: str) -> str:
+    archive, separator, _ = name.partition(archive_separator)
+    if separator and is_archive(archive):
+        return archive
+    return None
+
+
+# Iterate over the image members of an archive, in the order they are stored
+# Yields the member name and a function which reads the member's bytes, which must be called before moving on to the
+# next member since tar archives are read as a stream
+def iter_archive_images(archive_path: str, file_types: List[str]) -> Iterator[Tuple[str, Callable[[], bytes]]]:
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.split(".")[-1] not in file_types:
+                    continue
+                yield info.filename, partial(archive.read, info)
+    else:
+        with tarfile.open(archive_path, "r|*") as archive:
+            for member in archive:
+                if not member.isfile() or member.name.split(".")[-1] not in file_types:
+                    continue
+                yield member.name, partial(_read_tar_member, archive, member)
+
+
+def _read_tar_member(archive: tarfile.TarFile, member: tarfile.TarInfo) -> bytes:
+    with archive.extractfile(member) as member_file:
+        return member_file.read()
+
+
+# An ImageWorker for an image stored inside an archive, which is decoded straight from memory
+# The name of the worker is the archive name and the member name joined by the archive separator
+class ArchiveImageWorker(ImageWorker):
+    # Archived images can't be moved, so groups containing them are only reported
+    movable = False
+
+    # Decode the image from the archive member's bytes
+    def load_image(self) -> Image.Image:
+        if self.data is None:
+            raise Exception(f"Image {self.name} was not read from its archive")
+        return super().load_image()
+
+    def plan_move(self, new_path: str) -> List[Tuple[str, str]]:
+        raise Exception(f"Image {self.name} is inside an archive and can't be moved")
@@ -0,0 +1,138 @@
+import numpy as np
+from . import database_worker
+from typing import Iterator, List, Tuple
+
+# The version of the export format, stored in every export
+export_version = 1
+hash_columns = ["p_hash", "a_hash", "d_hash"]
+# How many rows are read from the database at a time
+fetch_size = 50000
+
+
+# Export the image, image_hashes and image_ignore tables into a compressed .npz file
+# Every column is stored as its own array: md5s as 16 byte rows, hashes as rows of little endian uint64 words (the
+# first word holding the lowest bits), and missing widths and heights as -1
+# Each table is read in chunks straight into arrays sized up front, so no more than a chunk of rows is held at a time
+def export_db(db_path: str, output_path: str, verbose: bool) -> None:
+    worker = database_worker.DatabaseWorker(db_path, verbose)
+    arrays = {"version": np.array([export_version])}
+
+    worker.execute("SELECT COUNT(*), MAX(LENGTH(name)), MAX(LENGTH(created)) FROM image ;", "")
+    count, name_length, created_length = worker.get_single_result()
+    arrays["image_md5"] = np.empty((count, 16), dtype=np.uint8)
+    arrays["image_name"] = np.empty(count, dtype=f"<U{name_length or 1}")
+    arrays["image_created"] = np.empty(count, dtype=f"<U{created_length or 1}")
+    arrays["image_width"] = np.empty(count, dtype=np.int64)
+    arrays["image_height"] = np.empty(count, dtype=np.int64)
+    worker.execute("SELECT md5_hash, name, created, width, height FROM image ;", "")
+    for rows, start, end in _iter_chunks(worker, count):
+        arrays["image_md5"][start:end] = _md5s_to_array([row[0] for row in rows])
+        arrays["image_name"][start:end] = [row[1] for row in rows]
+        arrays["image_created"][start:end] = [row[2] or "" for row in rows]
+        arrays["image_width"][start:end] = [-1 if row[3] is None else row[3] for row in rows]
+        arrays["image_height"][start:end] = [-1 if row[4] is None else row[4] for row in rows]
+
+    # Hashes are hex strings whose length depends on the reduced size factor, so use as many words as the longest needs
+    worker.execute("SELECT COUNT(*), " + ", ".join(f"MAX(LENGTH({column}))" for column in hash_columns)
+                   + " FROM image_hashes ;", "")
+    count, *hash_lengths = worker.get_single_result()
+    words = [max(1, ((length or 2) - 2 + 15) // 16) for length in hash_lengths]
+    arrays["hashes_md5"] = np.empty((count, 16), dtype=np.uint8)
+    for column, column_words in zip(hash_columns, words):
+        arrays[f"hashes_{column}"] = np.empty((count, column_words), dtype="<u8")
+    arrays["hashes_reduced_size_factor"] = np.empty(count, dtype=np.int32)
+    worker.execute(f"SELECT md5_hash, {', '.join(hash_columns)}, reduced_size_factor FROM image_hashes ;", "")
+    for rows, start, end in _iter_chunks(worker, count):
+        arrays["hashes_md5"][start:end] = _md5s_to_array([row[0] for row in rows])
+        for i, (column, column_words) in enumerate(zip(hash_columns, words)):
+            arrays[f"hashes_{column}"][start:end] = _hashes_to_array([row[i + 1] for row in rows], column_words)
+        arrays["hashes_reduced_size_factor"][start:end] = [row[4] for row in rows]
+
+    worker.execute("SELECT COUNT(*), MAX(LENGTH(created)) FROM image_ignore ;", "")
+    count, created_length = worker.get_single_result()
+    arrays["ignore_md5_1"] = np.empty((count, 16), dtype=np.uint8)
+    arrays["ignore_md5_2"] = np.empty((count, 16), dtype=np.uint8)
+    arrays["ignore_created"] = np.empty(count, dtype=f"<U{created_length or 1}")
+    worker.execute("SELECT md5_hash_1, md5_hash_2, created FROM image_ignore ;", "")
+    for rows, start, end in _iter_chunks(worker, count):
+        arrays["ignore_md5_1"][start:end] = _md5s_to_array([row[0] for row in rows])
+        arrays["ignore_md5_2"][start:end] = _md5s_to_array([row[1] for row in rows])
+        arrays["ignore_created"][start:end] = [row[2] or "" for row in rows]
+
+    np.savez_compressed(output_path, **arrays)
+    print(f"Exported {len(arrays['image_md5'])} images, {len(arrays['hashes_md5'])} hashes and "
+          f"{len(arrays['ignore_md5_1'])} ignore requests")
+
+
+# Import an export created by export_db, merging it into the database
+# Rows which already exist in the database are kept as they are, so imports can be repeated or merged in any order
+def import_db(db_path: str, input_path: str, verbose: bool) -> None:
+    arrays = np.load(input_path)
+    if arrays["version"][0] > export_version:
+        raise Exception(f"Export version {arrays['version'][0]} is newer than the supported version {export_version}")
+
+    worker = database_worker.DatabaseWorker(db_path, verbose)
+    # Rows which already exist are ignored, so count the rows each insert actually added
+    changes = worker.get_total_changes()
+    images = list(zip(_array_to_md5s(arrays["image_md5"]), arrays["image_name"].tolist(),
+                      _blank_to_none(arrays["image_created"]), _negative_to_none(arrays["image_width"]),
+                      _negative_to_none(arrays["image_height"])))
+    worker.execute_many("INSERT OR IGNORE INTO image (md5_hash, name, created, width, height) "
+                        "VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?) ;", images)
+    imported_images, changes = worker.get_total_changes() - changes, worker.get_total_changes()
+
+    hashes = list(zip(_array_to_md5s(arrays["hashes_md5"]),
+                      *[_array_to_hashes(arrays[f"hashes_{column}"]) for column in hash_columns],
+                      arrays["hashes_reduced_size_factor"].tolist()))
+    worker.execute_many("INSERT OR IGNORE INTO image_hashes (md5_hash, p_hash, a_hash, d_hash, reduced_size_factor) "
+                        "VALUES (?, ?, ?, ?, ?) ;", hashes)
+    imported_hashes, changes = worker.get_total_changes() - changes, worker.get_total_changes()
+
+    ignores = list(zip(_array_to_md5s(arrays["ignore_md5_1"]), _array_to_md5s(arrays["ignore_md5_2"]),
+                       _blank_to_none(arrays["ignore_created"])))
+    worker.execute_many("INSERT OR IGNORE INTO image_ignore (md5_hash_1, md5_hash_2, created) "
+                        "VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP)) ;", ignores)
+    imported_ignores = worker.get_total_changes() - changes
+
+    # Commit everything at once so a failed import doesn't leave a partial merge behind
+    worker.commit_changes()
+    print(f"Imported {imported_images} of {len(images)} images, {imported_hashes} of {len(hashes)} hashes and "
+          f"{imported_ignores} of {len(ignores)} ignore requests (the rest were already in the database)")
+
+
+def _iter_chunks(worker: database_worker.DatabaseWorker, count: int) -> Iterator[Tuple[List[any], int, int]]:
+    start = 0
+    rows = worker.get_results(fetch_size)
+    while rows:
+        if start + len(rows) > count:
+            raise Exception("The database changed while it was being exported")
+        yield rows, start, start + len(rows)
+        start += len(rows)
+        rows = worker.get_results(fetch_size)
+
+
+def _md5s_to_array(md5s: List[str]) -> np.ndarray:
+    return np.frombuffer(bytes.fromhex("".join(md5s)), dtype=np.uint8).reshape(len(md5s), 16)
+
+
+def _array_to_md5s(array: np.ndarray) -> List[str]:
+    return [row.tobytes().hex() for row in array]
+
+
+# Convert hex hashes into rows of the given amount of words, all at once rather than one Python int at a time
+def _hashes_to_array(hashes: List[str], words: int) -> np.ndarray:
+    data = bytes.fromhex("".join(hash_val[2:].zfill(words * 16) for hash_val in hashes))
+    # The padded hex is big endian, so the words come out highest first and have to be reversed
+    return np.frombuffer(data, dtype=">u8").reshape(len(hashes), words)[:, ::-1].astype("<u8")
+
+
+def _array_to_hashes(array: np.ndarray) -> List[str]:
+    return [hex(int.from_bytes(row.tobytes(), "little")) for row in array.astype("<u8")]
+
+
+def _blank_to_none(array: np.ndarray) -> List[str]:
+    return [value or None for value in array.tolist()]
+
+
+def _negative_to_none(array: np.ndarray) -> List[int]:
+    return [None if value < 0 else value for value in array.tolist()]
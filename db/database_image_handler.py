@@ -51,6 +51,22 @@ class DatabaseImageHandler:
                              "p_hash": p_hash, "size": reduced_size_factor})
         self.worker.commit_changes()
 
+    # Save the information of many images in a single transaction, skipping images which already exist
+    def save_images(self, images: List[Dict[str, any]]) -> None:
+        if not images:
+            return
+        self.worker.execute_many("INSERT OR IGNORE INTO image (md5_hash, name, width, height) "
+                                 "VALUES (:md5, :name, :width, :height);", images)
+        self.worker.commit_changes()
+
+    # Save the hash information of many images in a single transaction, skipping hashes which already exist
+    def save_image_hashes(self, hashes: List[Dict[str, any]]) -> None:
+        if not hashes:
+            return
+        self.worker.execute_many("INSERT OR IGNORE INTO image_hashes (md5_hash, a_hash, d_hash, p_hash, "
+                                 "reduced_size_factor) VALUES (:md5, :a_hash, :d_hash, :p_hash, :size)", hashes)
+        self.worker.commit_changes()
+
     # Save an image ignore request
     def save_ignore_similarity(self, md5_1: str, md5_2: str):
         self.worker.execute("INSERT INTO image_ignore (md5_hash_1, md5_hash_2) VALUES "
@@ -39,14 +39,32 @@ class DatabaseWorker:
             raise Exception('Did not receive successful insert status for'
                             f' { {sql} }, message is { {str(e)} }', e)
 
+    # Execute a SQL query once for each set of bindings
+    def execute_many(self, sql: str, bindings: List[any]):
+        try:
+            if self.verbose:
+                print(f"--- Executing sql statement ---\n{sql}\nwith {len(bindings)} sets of bindings")
+            self.__cursor.executemany(sql, bindings)
+        except (DatabaseError, IntegrityError, ProgrammingError) as e:
+            raise Exception('Did not receive successful insert status for'
+                            f' { {sql} }, message is { {str(e)} }', e)
+
     # Return the result of a query
     def get_result(self) -> List[any]:
         return self.__cursor.fetchall()
 
+    # Get the next results of the query, at most size of them (an empty list once there are no more)
+    def get_results(self, size: int) -> List[any]:
+        return self.__cursor.fetchmany(size)
+
     # Get a single result from the query
     def get_single_result(self) -> List[any]:
         return self.__cursor.fetchone()
 
+    # Get the amount of rows changed through this connection so far
+    def get_total_changes(self) -> int:
+        return self.__db.total_changes
+
     # Commit changes to the db
     def commit_changes(self) -> None:
         self.__db.commit()
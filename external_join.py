@@ -0,0 +1,216 @@
+from db.database_worker import DatabaseWorker
+from itertools import groupby
+from math import ceil
+from os import path, remove
+from result_stream import ResultStream
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Tuple
+from zlib import crc32
+
+default_memory_limit_mb = 512
+hash_columns = {"P": "p_hash", "PERCEPTION": "p_hash", "A": "a_hash", "AVERAGE": "a_hash",
+                "D": "d_hash", "DIFFERENCE": "d_hash"}
+# How many rows are read from the database at a time
+fetch_size = 10000
+# How many times an oversized partition is split again before it's joined in blocks instead
+max_split_depth = 3
+# How many smaller partitions an oversized partition is split into
+split_fanout = 16
+# Records take up several times their size on disk once loaded, so only this fraction of the memory limit is used for
+# the raw records of a partition (and for buffered records while spilling)
+memory_fraction = 8
+
+
+# A class for finding all similar pairs of hashes in the database without holding them all in memory
+# Uses the pigeonhole principle: if two hashes differ in at most `precision` characters, then splitting both into
+# precision + 1 segments leaves at least one segment that is exactly equal. So every hash is spilled to disk once per
+# segment keyed by (segment, value), the spilled records are partitioned so each partition fits in memory, and each
+# partition is sorted to find the hashes sharing a key. Those candidate pairs are then verified with their full distance
+class ExternalHashJoin:
+    def __init__(self, db_path: str, precision: int, memory_limit: int, temp_dir: str = None, verbose: bool = False):
+        self.db_path = db_path
+        # The amount of characters that can differ in a hash before two images are considered different
+        self.precision = precision
+        # The amount of bytes the join may use
+        self.memory_limit = memory_limit
+        # Where partition files are spilled (the system default if not set)
+        self.temp_dir = temp_dir
+        self.verbose = verbose
+        # The bytes of records allowed in a single partition, and in the spill buffers
+        self.partition_bytes = max(1, memory_limit // memory_fraction)
+
+    # Join all hashes of the given method and reduced size factor, writing every similar pair to the stream
+    # Returns the amount of pairs found
+    def run(self, comparison_method: str, reduced_size_factor: int, stream: ResultStream) -> int:
+        column = hash_columns[comparison_method]
+        worker = DatabaseWorker(self.db_path, self.verbose)
+
+        worker.execute(f"SELECT COUNT(*), MAX(LENGTH({column})) FROM image_hashes "
+                       "WHERE reduced_size_factor = :size ;", {"size": reduced_size_factor})
+        count, max_length = worker.get_single_result()
+        if not count:
+            print("No hashes found to join")
+            return 0
+
+        # Hashes drop their leading zeros, so pad every hash (without its 0x prefix) to the same length
+        hash_length = max_length - 2
+        segment_count = self.precision + 1
+        if segment_count > hash_length:
+            raise Exception(f"A precision of {self.precision} allows every character of a {hash_length} character hash "
+                            "to differ, so every pair would be similar")
+        bounds = [round(i * hash_length / segment_count) for i in range(segment_count + 1)]
+
+        # Estimate the spilled size to pick a partition count where each partition fits in memory
+        record_size = hash_length // segment_count + hash_length + 40
+        partition_count = max(1, ceil(count * segment_count * record_size / self.partition_bytes))
+        if self.verbose:
+            print(f"Joining {count} hashes in {segment_count} segments over {partition_count} partitions")
+
+        pairs = 0
+        with TemporaryDirectory(dir=self.temp_dir) as spill_dir:
+            partitions = [path.join(spill_dir, f"partition_{i}") for i in range(partition_count)]
+
+            # Spill (segment, value, md5, hash) records into partitions by their key
+            worker.execute(f"SELECT md5_hash, {column} FROM image_hashes WHERE reduced_size_factor = :size ;",
+                           {"size": reduced_size_factor})
+            buffers = {}
+            buffered = 0
+            rows = worker.get_results(fetch_size)
+            while rows:
+                for md5, hash_val in rows:
+                    hash_val = hash_val[2:].zfill(hash_length)
+                    for segment in range(segment_count):
+                        value = hash_val[bounds[segment]:bounds[segment + 1]]
+                        record = f"{segment}\t{value}\t{md5}\t{hash_val}\n"
+                        buffers.setdefault(self._partition(0, segment, value, partition_count), []).append(record)
+                        buffered += len(record)
+                if buffered >= self.partition_bytes:
+                    self._flush(buffers, partitions)
+                    buffered = 0
+                rows = worker.get_results(fetch_size)
+            self._flush(buffers, partitions)
+
+            # Join each partition on its own
+            for partition in partitions:
+                if path.exists(partition):
+                    pairs += self._join_partition(partition, 0, bounds, stream)
+
+        print(f"Found {pairs} similar pairs among {count} hashes")
+        return pairs
+
+    # Find the key's partition, salted by the split depth so that oversized partitions can be split again
+    @staticmethod
+    def _partition(depth: int, segment: int, value: str, partition_count: int) -> int:
+        return crc32(f"{depth}:{segment}:{value}".encode("utf-8")) % partition_count
+
+    # Append buffered records to their partition files and empty the buffers
+    @staticmethod
+    def _flush(buffers: Dict[int, List[str]], partitions: List[str]) -> None:
+        for i, records in buffers.items():
+            with open(partitions[i], "a") as partition_file:
+                partition_file.writelines(records)
+        buffers.clear()
+
+    # Join the records of a single partition, splitting it further if it's too large to fit in memory
+    def _join_partition(self, partition: str, depth: int, bounds: List[int], stream: ResultStream) -> int:
+        if path.getsize(partition) > self.partition_bytes:
+            if depth < max_split_depth:
+                if self.verbose:
+                    print(f"Splitting oversized partition {partition}")
+                return self._split_partition(partition, depth + 1, bounds, stream)
+            # Splitting can't help once most of the partition shares a few keys, so join it in blocks instead
+            if self.verbose:
+                print(f"Joining oversized partition {partition} in blocks")
+            return self._block_join_partition(partition, bounds, stream)
+
+        with open(partition, "r") as partition_file:
+            records = [self._parse_record(line) for line in partition_file]
+        remove(partition)
+        # Sort by segment and value so all records sharing a key are next to each other
+        records.sort(key=lambda record: (int(record[0]), record[1]))
+
+        return sum(self._join_group(list(group), segment, bounds, stream)
+                   for (segment, _), group in groupby(records, key=lambda record: (int(record[0]), record[1])))
+
+    # Join a partition too large to fit in memory, one block of records at a time
+    # Each block is joined with itself and then with every record after it, which is streamed from disk one record at a
+    # time, so every pair is found once while only a single block is held in memory
+    def _block_join_partition(self, partition: str, bounds: List[int], stream: ResultStream) -> int:
+        pairs = 0
+        with open(partition, "r") as partition_file:
+            while True:
+                # Load the next block of records, grouped by their (segment, value) key
+                block = {}
+                loaded = 0
+                while loaded < self.partition_bytes:
+                    line = partition_file.readline()
+                    if not line:
+                        break
+                    loaded += len(line)
+                    record = self._parse_record(line)
+                    block.setdefault((int(record[0]), record[1]), []).append(record)
+                if not block:
+                    break
+                block_end = partition_file.tell()
+
+                for (segment, _), group in block.items():
+                    pairs += self._join_group(group, segment, bounds, stream)
+
+                for line in iter(partition_file.readline, ""):
+                    record = self._parse_record(line)
+                    segment = int(record[0])
+                    for other in block.get((segment, record[1]), []):
+                        distance = self._verify(other[3], record[3], segment, bounds)
+                        if distance is not None:
+                            stream.emit_pair(other[2], record[2], distance)
+                            pairs += 1
+
+                partition_file.seek(block_end)
+        remove(partition)
+        return pairs
+
+    # Verify every pair of records sharing the same key, writing the similar pairs to the stream
+    def _join_group(self, group: List[Tuple[str, ...]], segment: int, bounds: List[int], stream: ResultStream) -> int:
+        pairs = 0
+        for i in range(len(group)):
+            for j in range(i + 1, len(group)):
+                distance = self._verify(group[i][3], group[j][3], segment, bounds)
+                if distance is not None:
+                    stream.emit_pair(group[i][2], group[j][2], distance)
+                    pairs += 1
+        return pairs
+
+    @staticmethod
+    def _parse_record(line: str) -> Tuple[str, ...]:
+        return tuple(line.rstrip("\n").split("\t"))
+
+    # Split a partition into smaller partitions and join each of them
+    def _split_partition(self, partition: str, depth: int, bounds: List[int], stream: ResultStream) -> int:
+        partitions = [f"{partition}_{i}" for i in range(split_fanout)]
+        buffers = {}
+        buffered = 0
+        with open(partition, "r") as partition_file:
+            for line in partition_file:
+                segment, value, _ = line.split("\t", 2)
+                buffers.setdefault(self._partition(depth, int(segment), value, split_fanout), []).append(line)
+                buffered += len(line)
+                if buffered >= self.partition_bytes:
+                    self._flush(buffers, partitions)
+                    buffered = 0
+        self._flush(buffers, partitions)
+        remove(partition)
+
+        return sum(self._join_partition(sub_partition, depth, bounds, stream)
+                   for sub_partition in partitions if path.exists(sub_partition))
+
+    # Get the distance of a candidate pair found through the given segment, or None if the pair isn't similar
+    # A pair sharing several segments is found once per shared segment, so it's only kept for the first one
+    def _verify(self, hash_a: str, hash_b: str, segment: int, bounds: List[int]) -> int:
+        # The amount of differing characters, the same as ImageWorker.hamming_distance on padded hashes
+        distance = sum(a != b for a, b in zip(hash_a, hash_b))
+        if distance > self.precision:
+            return None
+        for earlier in range(segment):
+            if hash_a[bounds[earlier]:bounds[earlier + 1]] == hash_b[bounds[earlier]:bounds[earlier + 1]]:
+                return None
+        return distance
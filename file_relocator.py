@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from math import ceil
+import filecmp
+from os import link, makedirs, path, remove, rename, rmdir, symlink
+from run_journal import RunJournal
+from typing import List, Optional, Tuple
+
+link_modes = ["move", "hardlink", "reflink", "symlink", "report"]
+default_relocation_threads = 8
+# The most file operations handed to a thread at once. Batches keep the overhead of the pool small next to fast local
+# operations, while there are still several batches per thread to spread slow (network) operations over the pool
+relocation_batch_size = 64
+# How many finished operations are recorded in the journal before it's synced to disk
+journal_sync_interval = 500
+# The ioctl request for cloning a file's extents into another file (Linux), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+# A class for relocating grouped images, performing file operations in parallel and recording each one in the run
+# journal so that interrupted relocations can be finished or rolled back
+class FileRelocator:
+    def __init__(self, link_mode: str = "move", threads: int = default_relocation_threads, verbose: bool = False):
+        if link_mode not in link_modes:
+            raise Exception(f"Unknown link mode {link_mode}, expected one of {', '.join(link_modes)}")
+        # How images are put into their group folders, report only prints groups without touching any files
+        self.link_mode = link_mode
+        # The amount of file operations performed at the same time, which mostly helps on network file systems
+        self.threads = threads
+        self.verbose = verbose
+
+    # Perform a list of (source, destination) operations with the given link mode, recording each finished one in the
+    # journal. The operations must already be recorded in the journal
+    def relocate(self, operations: List[Tuple[str, str]], journal: RunJournal, link_mode: str = None) -> None:
+        link_mode = link_mode or self.link_mode
+        if not operations:
+            return
+
+        batch_size = max(1, min(relocation_batch_size, ceil(len(operations) / (self.threads * 4))))
+        errors = []
+        finished = 0
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            # Create every destination directory up front, once per directory rather than once per file. These are
+            # the costly metadata operations on network file systems, so they are spread over the pool as well
+            directories = sorted({path.dirname(destination) for _, destination in operations})
+            for future in [executor.submit(self._make_directories, directories[i:i + batch_size])
+                           for i in range(0, len(directories), batch_size)]:
+                future.result()
+
+            futures = [executor.submit(self._relocate_batch, operations[i:i + batch_size], link_mode)
+                       for i in range(0, len(operations), batch_size)]
+            try:
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    done, error = future.result()
+                    for operation in done:
+                        journal.record_moved(operation)
+                        finished += 1
+                        if finished % journal_sync_interval == 0:
+                            journal.sync()
+                    if error is not None:
+                        operation, e = error
+                        print(f"Could not {link_mode} {operation[0]} to {operation[1]}: {e}")
+                        errors.append(operation)
+                        # Stop starting new operations, the journal makes it possible to finish or undo them later
+                        for other in futures:
+                            other.cancel()
+            finally:
+                journal.sync()
+
+        if errors:
+            raise Exception(f"{len(errors)} files could not be relocated, run again with --resume to finish "
+                            f"relocating or with --rollback to undo it")
+
+    # Undo every operation recorded in the journal, then remove the directories they created
+    # Every planned operation is checked rather than only the ones recorded as finished, since a crash can happen after
+    # an operation is performed but before it's recorded
+    def rollback(self, journal: RunJournal) -> None:
+        undone = 0
+        for source, destination in reversed(journal.moves):
+            if journal.link_mode == "move":
+                if path.exists(destination) and not path.exists(source):
+                    rename(destination, source)
+                    undone += 1
+            elif self._is_created_link(source, destination, journal.link_mode):
+                remove(destination)
+                undone += 1
+
+        # Remove the created directories inside the working dir, deepest first, as long as they are empty
+        working_dir = journal.header["working_dir"]
+        directories = {path.abspath(path.dirname(destination)) for _, destination in journal.moves}
+        for directory in sorted(directories, key=lambda d: d.count(path.sep), reverse=True):
+            while directory.startswith(working_dir + path.sep):
+                try:
+                    rmdir(directory)
+                except OSError:
+                    break
+                directory = path.dirname(directory)
+
+        print(f"Rolled back {undone} of {len(journal.moves)} relocated files")
+
+    @staticmethod
+    def _make_directories(directories: List[str]) -> None:
+        for directory in directories:
+            makedirs(directory, exist_ok=True)
+
+    # Perform a batch of operations, stopping at the first one which fails
+    # Returns the finished operations, and the failed operation with its error if there was one
+    def _relocate_batch(self, operations: List[Tuple[str, str]],
+                        link_mode: str) -> Tuple[List[Tuple[str, str]], Optional[Tuple[Tuple[str, str], OSError]]]:
+        done = []
+        for operation in operations:
+            try:
+                self._relocate_file(operation, link_mode)
+            except OSError as e:
+                return done, (operation, e)
+            done.append(operation)
+        return done, None
+
+    @staticmethod
+    def _relocate_file(operation: Tuple[str, str], link_mode: str) -> None:
+        source, destination = operation
+        try:
+            if link_mode == "move":
+                rename(source, destination)
+            elif link_mode == "hardlink":
+                link(source, destination)
+            elif link_mode == "symlink":
+                symlink(path.abspath(source), destination)
+            elif link_mode == "reflink":
+                FileRelocator._reflink(source, destination)
+        except (FileNotFoundError, FileExistsError):
+            # If the destination already exists, the operation was done before it could be recorded in the journal
+            if not path.lexists(destination):
+                raise
+
+    # Determine if the destination is the link or clone this run created from the source, so that files which were
+    # already there (or were replaced since) are never removed by a rollback
+    @staticmethod
+    def _is_created_link(source: str, destination: str, link_mode: str) -> bool:
+        if link_mode == "symlink":
+            return path.islink(destination) and path.realpath(destination) == path.realpath(source)
+        if not path.isfile(destination) or path.islink(destination) or not path.isfile(source):
+            return False
+        if link_mode == "hardlink":
+            return path.samefile(source, destination)
+        if link_mode == "reflink":
+            # A clone is a separate file, so the best that can be checked is that it still has the same contents
+            return not path.samefile(source, destination) and filecmp.cmp(source, destination, shallow=False)
+        return False
+
+    # Create a copy-on-write clone of a file, which is only supported by some file systems (e.g. btrfs, xfs)
+    @staticmethod
+    def _reflink(source: str, destination: str) -> None:
+        from fcntl import ioctl
+
+        with open(source, "rb") as source_file, open(destination, "xb") as destination_file:
+            try:
+                ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            except OSError:
+                destination_file.close()
+                remove(destination)
+                raise
@@ -1,11 +1,19 @@
+from archive_image_worker import ArchiveImageWorker, archive_separator, get_archive_name, is_archive, \
+    iter_archive_images
 import asyncio
+from db.database_image_handler import DatabaseImageHandler
+from file_relocator import FileRelocator
+from image_shards import ShardCoordinator
 from image_worker import ImageWorker
-from os import path, listdir, mkdir
+from os import path, listdir
+from run_journal import RunJournal, default_journal_path
 import time
 from random import randrange
-from typing import Dict, List
+from result_stream import ResultStream
+from typing import Callable, Dict, Iterator, List
 
 default_working_dir = "./images/"
+default_checkpoint_size = 100
 file_types = ["jpeg", "png", "jpg"]
 
 
@@ -13,7 +21,10 @@ class ImageLoadOrchastrator:
     __instance = None
 
     @classmethod
-    def get_instance(cls, working_dir, db_path, verbose, precision, reduced_size_factor) -> 'ImageLoadOrchastrator':
+    def get_instance(cls, working_dir, db_path, verbose, precision, reduced_size_factor,
+                     checkpoint_size=default_checkpoint_size,
+                     journal_path=default_journal_path, orientation_invariant=False,
+                     prefetcher=None) -> 'ImageLoadOrchastrator':
         # Create singleton of this class, and return the existing instance if it exists
         if cls.__instance is None:
             cls.__instance = cls.__new__(cls)
@@ -27,6 +38,14 @@ class ImageLoadOrchastrator:
             cls.__instance.precision = precision
             # The factor to reduce the image size by
             cls.__instance.reduced_size_factor = reduced_size_factor
+            # The amount of images to hash before saving them to the db and the run journal
+            cls.__instance.checkpoint_size = checkpoint_size
+            # The path to the run journal, used to resume interrupted runs
+            cls.__instance.journal_path = journal_path
+            # Whether or not mirrored and rotated copies of images should be considered alike
+            cls.__instance.orientation_invariant = orientation_invariant
+            # The ImagePrefetcher reading image files ahead of decoding, or None to read each file when it's decoded
+            cls.__instance.prefetcher = prefetcher
         return cls.__instance
 
     # Only allow creation through get_instance method
@@ -34,7 +53,12 @@ class ImageLoadOrchastrator:
         raise RuntimeError("Call get_instance() instead")
 
     # Run the comparison routine
-    async def run(self, comparison_method: str, avoid_db: bool) -> None:
+    # If a shard coordinator is given, images are hashed by its shard workers instead of locally
+    # The relocator determines how grouped images are put into their group folders (moved by default)
+    # If a result stream is given, matches are written to it as soon as they are found
+    async def run(self, comparison_method: str, avoid_db: bool, resume: bool = False,
+                  coordinator: ShardCoordinator = None, relocator: FileRelocator = None,
+                  stream: ResultStream = None) -> None:
         # Make sure the provided path to images exists
         if not path.isdir(self.working_dir):
             raise Exception("Working dir does not exist")
@@ -43,36 +67,55 @@ class ImageLoadOrchastrator:
         files = [file for file in listdir(self.working_dir) if path.isfile(
             path.join(self.working_dir, file))]
 
-        # Initialize the start time (for stats purposes) and list of tasks
-        tasks = []
+        if relocator is None:
+            relocator = FileRelocator(verbose=self.verbose)
+
+        # Initialize the start time (for stats purposes)
         start = time.time()
         print(f"Starting... current time is {time.strftime('%H:%M:%S')}")
 
-        # Create an async worker for each file (to get a hash of the file) and run
-        for i, file in enumerate(files):
-            # Make sure the filetype is one of the allowed types
-            if file.split(".")[-1] not in file_types:
-                continue
-            # Create the ImageWorker for the image, start it, and append the task to our list of tasks
-            worker = ImageWorker(self.working_dir, str(file), self.reduced_size_factor, avoid_db)
-            tasks.append(asyncio.create_task(worker.construct(comparison_method, self.db_path,
-                                                              self.verbose)))
+        # Open the run journal, picking up where the last run left off if requested
+        journal = RunJournal(self.journal_path, self.working_dir, comparison_method, self.reduced_size_factor,
+                             avoid_db, self.orientation_invariant)
+        if resume and journal.load():
+            print(f"Resuming previous run, {len(journal.done)} files were already finished")
+        else:
+            journal.start()
 
-        # Wait until all workers are done and gather into a list of completed workers
-        fulfilled_workers = await asyncio.gather(*tasks)
+        # If the previous run already started moving files, all images were hashed and grouped, so only finish moving
+        if journal.moves:
+            relocator.relocate(journal.pending_moves(), journal, journal.link_mode)
+        else:
+            # Workers by MD5 (trimming out all exact matches), which each batch of hashed images is compared against
+            workers = {}
 
-        # Get workers (trim out all exact matches) and find similar images
-        workers = await self.get_workers(fulfilled_workers)
+            def on_batch(batch: List[ImageWorker]) -> None:
+                self.add_workers(batch, workers, stream)
 
-        # Get groupings of alike and exact matches
-        groups = self.get_groupings(workers)
+            # Hash all images, checkpointing results and finding similar images along the way
+            if coordinator is not None:
+                await self.construct_sharded_workers(files, comparison_method, avoid_db, journal, coordinator,
+                                                     on_batch)
+            else:
+                await self.construct_workers(files, comparison_method, avoid_db, journal, on_batch)
 
-        # Move each image into its new folder for comparison
-        self.move_groups(groups)
+            # Get groupings of alike and exact matches
+            groups = self.get_groupings(workers)
 
-        # Finish by saving all images to the database if we're not avoiding it
-        if not avoid_db:
-            await self.save_image_data(workers)
+            # Every image has been seen, so no group can change anymore
+            if stream is not None:
+                for group in groups:
+                    stream.emit_group(group)
+
+            # Move each image into its new folder for comparison
+            self.move_groups(groups, journal, relocator)
+
+            # Finish by saving all images to the database if we're not avoiding it
+            if not avoid_db:
+                await self.save_image_data(workers)
+
+        # Everything finished successfully, so the journal is no longer needed
+        journal.finish()
 
         end = time.time()
         diff = end - start
@@ -81,6 +124,151 @@ class ImageLoadOrchastrator:
               .format(file_len=len(files), time=time.strftime("%H:%M:%S"), hours=diff // 3600,
                       minutes=(diff // 60) % 60, seconds=diff % 60))
 
+    # Create and construct workers for all images, saving results to the database and the journal in batches
+    # Each batch of finished workers is passed to on_batch
+    async def construct_workers(self, files: List[str], comparison_method: str, avoid_db: bool,
+                                journal: RunJournal, on_batch: Callable[[List[ImageWorker]], None]) -> None:
+        restored = []
+        batch = []
+        for worker in self.iter_workers(files, avoid_db, journal.done):
+            # Files finished in a previous run are restored from the journal instead of being decoded again
+            if worker.name in journal.done:
+                restored.append(worker.restore(journal.done[worker.name], comparison_method, self.db_path,
+                                               self.verbose))
+                continue
+
+            # Otherwise construct the worker right away, so its file's bytes are released as soon as it's decoded
+            batch.append(await worker.construct(comparison_method, self.db_path, self.verbose))
+            if len(batch) >= self.checkpoint_size:
+                on_batch(restored + self.checkpoint(batch, avoid_db, journal))
+                restored = []
+                batch = []
+
+        on_batch(restored + (self.checkpoint(batch, avoid_db, journal) if batch else []))
+
+    # Hash all images on shard workers, merging each finished shard into the database and the journal as it arrives
+    # Each merged shard is passed to on_batch
+    async def construct_sharded_workers(self, files: List[str], comparison_method: str, avoid_db: bool,
+                                        journal: RunJournal, coordinator: ShardCoordinator,
+                                        on_batch: Callable[[List[ImageWorker]], None]) -> None:
+        restored = []
+
+        # Restore images finished in a previous run, an archive counts as finished once any of its images are since
+        # each archive is hashed (and merged) as a whole by a single shard
+        finished_files = set()
+        for name, entry in journal.done.items():
+            file = get_archive_name(name) or name
+            if file in files:
+                finished_files.add(file)
+                restored.append(self.create_worker(name, avoid_db).restore(entry, comparison_method, self.db_path,
+                                                                           self.verbose))
+        on_batch(restored)
+
+        # Merge the hashed images of a finished shard
+        def on_result(shard_id: int, entries: List[Dict[str, any]]) -> None:
+            workers = [self.create_worker(entry["name"], avoid_db).restore(entry, comparison_method, self.db_path,
+                                                                           self.verbose)
+                       for entry in entries if entry["name"] not in journal.done]
+            if not avoid_db:
+                self.save_batch(workers)
+            journal.record_done([worker.get_entry() for worker in workers])
+            on_batch(workers)
+            print(f"Merged shard {shard_id}, {len(journal.done)} files finished")
+
+        pending = [file for file in files if file not in finished_files
+                   and (is_archive(file) or file.split(".")[-1] in file_types)]
+        await coordinator.dispatch(pending, comparison_method, self.reduced_size_factor, self.orientation_invariant,
+                                   avoid_db, on_result)
+
+    # Hash the given files for a shard coordinator, returning the hash information of each image
+    # Only the hash of the comparison method is calculated if the coordinator is avoiding the database
+    async def hash_shard(self, files: List[str], comparison_method: str, reduced_size_factor: int,
+                         orientation_invariant: bool, avoid_db: bool) -> List[Dict[str, any]]:
+        if reduced_size_factor != self.reduced_size_factor:
+            raise Exception(f"Shard worker uses a reduced size factor of {self.reduced_size_factor}, "
+                            f"but {reduced_size_factor} was requested")
+        # Without the orientation variants, the coordinator would quietly fall back to comparing plain hashes
+        if orientation_invariant != self.orientation_invariant:
+            raise Exception(f"Shard worker is {'' if self.orientation_invariant else 'not '}orientation invariant, "
+                            f"but {'' if orientation_invariant else 'no '}orientation invariance was requested")
+
+        entries = []
+        for worker in self.iter_workers(files, True, {}):
+            await worker.construct(comparison_method, self.db_path, self.verbose)
+            # Calculate every hash if the coordinator saves them all to the database
+            if not avoid_db:
+                worker.complete()
+            entries.append(worker.get_entry())
+        return entries
+
+    # Create an (unconstructed) worker for the image with the given name
+    def create_worker(self, name: str, avoid_db: bool) -> ImageWorker:
+        if get_archive_name(name) is not None:
+            return ArchiveImageWorker(self.working_dir, name, self.reduced_size_factor, avoid_db,
+                                      orientation_invariant=self.orientation_invariant)
+        return ImageWorker(self.working_dir, name, self.reduced_size_factor, avoid_db, self.orientation_invariant)
+
+    # Create a worker for each image in the given files, including each image inside of archives
+    # Images which are already done are only created, and not read
+    def iter_workers(self, files: List[str], avoid_db: bool, done: Dict[str, any]) -> Iterator[ImageWorker]:
+        # Start reading the image files which still need to be decoded ahead of time
+        prefetched = None
+        if self.prefetcher is not None:
+            prefetched = self.prefetcher.iter_files([path.join(self.working_dir, file) for file in files
+                                                     if not is_archive(file) and file.split(".")[-1] in file_types
+                                                     and file not in done])
+
+        for file in files:
+            # Archives are read member by member, so only one member is held in memory at a time before decoding
+            if is_archive(file):
+                for member, read in iter_archive_images(path.join(self.working_dir, file), file_types):
+                    name = file + archive_separator + member
+                    # Finished members don't need to be read again
+                    data = read() if name not in done else None
+                    yield ArchiveImageWorker(self.working_dir, name, self.reduced_size_factor, avoid_db,
+                                             orientation_invariant=self.orientation_invariant, data=data)
+            # Otherwise make sure the filetype is one of the allowed types
+            elif file.split(".")[-1] in file_types:
+                data = next(prefetched)[1] if prefetched is not None and file not in done else None
+                yield ImageWorker(self.working_dir, str(file), self.reduced_size_factor, avoid_db,
+                                  orientation_invariant=self.orientation_invariant, data=data)
+
+    # Save a batch of finished workers to the database and record them as done in the journal
+    def checkpoint(self, workers: List[ImageWorker], avoid_db: bool, journal: RunJournal) -> List[ImageWorker]:
+        if not avoid_db:
+            self.save_batch(workers)
+        journal.record_done([worker.get_entry() for worker in workers])
+
+        # The decoded images aren't needed anymore now that they are hashed and saved, so release them
+        for worker in workers:
+            worker.image = None
+
+        if self.verbose:
+            print(f"Checkpoint reached, {len(journal.done)} files finished")
+        return workers
+
+    # Save a batch of workers to the database in a single transaction
+    def save_batch(self, workers: List[ImageWorker]) -> None:
+        to_save = [worker for worker in workers if not worker.exists or worker.new_hashes]
+        if not to_save:
+            return
+
+        # Finish creating all other hashes
+        for worker in to_save:
+            worker.complete()
+
+        image_handler = DatabaseImageHandler(self.db_path, self.verbose)
+        image_handler.save_images([{"md5": worker.md5, "name": worker.name, "width": worker.width,
+                                    "height": worker.height} for worker in to_save if not worker.exists])
+        image_handler.save_image_hashes([{"md5": worker.md5, "a_hash": worker.a_hash, "d_hash": worker.d_hash,
+                                          "p_hash": worker.p_hash, "size": worker.reduced_size_factor}
+                                         for worker in to_save if worker.new_hashes])
+
+        # Mark the workers as saved so they aren't saved again at the end of the run
+        for worker in to_save:
+            worker.exists = True
+            worker.new_hashes = False
+
     # Group all alike and exact images together
     @staticmethod
     def get_groupings(workers: Dict[str, ImageWorker]) -> List[List[ImageWorker]]:
@@ -103,36 +291,58 @@ class ImageLoadOrchastrator:
 
         return groups
 
-    # Trim down workers with the exact same MD5
-    async def get_workers(self, fulfilled_workers) -> Dict[str, ImageWorker]:
-        workers = {}
-        # Search through all workers
-        for i in range(len(fulfilled_workers)):
-            worker = fulfilled_workers[i]
-
-            # If no other worker with the given MD5 exists, add this and find all similar workers throughout the rest of
-            # the list
+    # Add new workers to the workers with a unique MD5, finding all similar workers among those already added
+    # Each exact and similar match found is written to the stream if one is given
+    def add_workers(self, new_workers: List[ImageWorker], workers: Dict[str, ImageWorker],
+                    stream: ResultStream = None) -> None:
+        for worker in new_workers:
+            # If no other worker with the given MD5 exists, add this and find all similar workers that were already
+            # added
             if worker.md5 not in workers:
+                matches = worker.check_alike(list(workers.values()), self.precision)
                 workers[worker.md5] = worker
-                worker.check_alike(fulfilled_workers[i + 1:], self.precision)
+                if stream is not None:
+                    for match, distance in matches:
+                        stream.emit_match(match, worker, distance)
             # Otherwise, add this worker to the already existing workers list of exact matches
             else:
                 workers[worker.md5].add_exact(worker)
-        return workers
+                if stream is not None:
+                    stream.emit_match(workers[worker.md5], worker, 0)
 
     # Loop through and move groups of images into new folders
-    def move_groups(self, groups: List[List[ImageWorker]]) -> None:
-        # Loop through and move each group
+    def move_groups(self, groups: List[List[ImageWorker]], journal: RunJournal, relocator: FileRelocator) -> None:
+        moves = []
+        # Plan the moves for each group
         for group in groups:
+            # Only report groups if we're not supposed to touch any files
+            if relocator.link_mode == "report":
+                self.report_group(group, "report only")
+                continue
+            # Images inside of archives can't be moved, so only report groups containing them
+            if not all(image.is_movable() for image in group):
+                self.report_group(group, "contains archived images")
+                continue
             # Create some random numerical suffix from 0 to 2^50
             random_suffix = hex(randrange(0, 2**50))
             # get the new path
             new_path = path.join(self.working_dir, random_suffix)
-            # Create the new directory
-            mkdir(new_path)
-            # Asynchronously move all images into the new directory
+            # Plan moving all images into the new directory
             for image in group:
-                image.move(new_path)
+                moves.extend(image.plan_move(new_path))
+
+        # Record all moves before performing any, so an interrupted run can finish or roll them back
+        journal.record_moves(moves, relocator.link_mode)
+        relocator.relocate(moves, journal)
+
+    # Print a group of similar images instead of moving them
+    @staticmethod
+    def report_group(group: List[ImageWorker], reason: str) -> None:
+        print(f"Found group of similar images (not moved, {reason}):")
+        for image in group:
+            print(f"  {image.name}")
+            for exact_image in image.exact:
+                print(f"    exact copy: {exact_image.name}")
 
     # Save all images to the database
     @staticmethod
@@ -143,6 +353,15 @@ class ImageLoadOrchastrator:
 
         await asyncio.gather(*tasks)
 
+    # Undo the relocation of an interrupted run, using its run journal
+    def rollback(self, relocator: FileRelocator) -> None:
+        journal = RunJournal(self.journal_path, self.working_dir, None, self.reduced_size_factor)
+        if not journal.load(match_settings=False):
+            raise Exception(f"No run journal found at {self.journal_path} for working dir {self.working_dir}")
+
+        relocator.rollback(journal)
+        journal.finish()
+
     # Add an ignore similarity request
     def ignore_similarity(self, image_1_name: str, image_2_name: str) -> None:
         if not path.isdir(self.working_dir):
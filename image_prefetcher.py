@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from threading import Condition
+from typing import Iterator, List, Tuple
+
+default_prefetch_threads = 4
+default_prefetch_mb = 256
+
+
+# A class for reading files ahead of time on a small thread pool, so that waiting on the disk (or network) overlaps with
+# decoding images instead of adding to it
+# Files are read whole, in the order they are requested, and at most byte_budget bytes are held before being consumed
+class ImagePrefetcher:
+    def __init__(self, threads: int = default_prefetch_threads, byte_budget: int = default_prefetch_mb * 2 ** 20,
+                 verbose: bool = False):
+        # The amount of files read at the same time
+        self.threads = threads
+        # The maximum amount of read but not yet consumed bytes
+        self.byte_budget = byte_budget
+        self.verbose = verbose
+
+    # Read the given files ahead of time, yielding each path and its bytes in order
+    def iter_files(self, paths: List[str]) -> Iterator[Tuple[str, bytes]]:
+        if not paths:
+            return
+
+        # The state shared with the reading threads: bytes currently held, the index of the next file to be consumed,
+        # and whether reading has been stopped
+        state = {"held": 0, "next": 0, "closed": False}
+        condition = Condition()
+
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        futures = []
+        try:
+            futures = [executor.submit(self._read, file_path, i, state, condition) for i, file_path in enumerate(paths)]
+            for i, future in enumerate(futures):
+                data = future.result()
+                with condition:
+                    state["held"] -= len(data)
+                    state["next"] = i + 1
+                    condition.notify_all()
+                yield paths[i], data
+        finally:
+            # Wake up any waiting threads so they can give up if we stopped early
+            with condition:
+                state["closed"] = True
+                condition.notify_all()
+            # Cancel the reads which haven't started yet (shutdown's cancel_futures needs Python 3.9)
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _read(self, file_path: str, index: int, state: dict, condition: Condition) -> bytes:
+        with open(file_path, "rb", buffering=0) as file:
+            size = os.fstat(file.fileno()).st_size
+
+            # Wait until the file fits in the budget. The next file to be consumed is always let through, otherwise a
+            # later file could hold the budget while the consumer waits on this one
+            with condition:
+                condition.wait_for(lambda: state["closed"] or index == state["next"]
+                                   or state["held"] + size <= self.byte_budget)
+                if state["closed"]:
+                    return b""
+                state["held"] += size
+
+            # Let the kernel know the whole file is about to be read sequentially
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            data = file.read()
+
+        # The file may have changed size since it was checked, so hold what was actually read
+        with condition:
+            state["held"] += len(data) - size
+
+        if self.verbose:
+            print(f"Prefetched {file_path} ({len(data)} bytes)")
+        return data
@@ -0,0 +1,172 @@
+import asyncio
+from hashlib import md5
+import json
+from typing import Callable, Dict, List, Tuple
+
+default_shard_retries = 3
+# How many seconds a shard worker may take to hash a shard and respond
+default_shard_timeout = 600
+
+
+# An error reported by a shard worker while hashing a shard
+class ShardError(Exception):
+    pass
+
+
+# Messages are sent as a 4 byte big endian length followed by that many bytes of UTF-8 JSON
+async def send_message(writer: asyncio.StreamWriter, message: Dict[str, any]) -> None:
+    data = json.dumps(message).encode("utf-8")
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+
+
+async def read_message(reader: asyncio.StreamReader) -> Dict[str, any]:
+    length = int.from_bytes(await reader.readexactly(4), "big")
+    return json.loads((await reader.readexactly(length)).decode("utf-8"))
+
+
+# Split a HOST:PORT address into its parts
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit():
+        raise Exception(f"Invalid shard worker address {address}, expected HOST:PORT")
+    return host, int(port)
+
+
+# Serve shard requests, hashing the requested files with the given orchestrator
+async def serve_shards(address: str, orc) -> None:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                if orc.verbose:
+                    print(f"Hashing shard {request['shard_id']} ({len(request['files'])} files)")
+                try:
+                    entries = await orc.hash_shard(request["files"], request["method"], request["reduced_size_factor"],
+                                                   request["orientation_invariant"], request["avoid_db"])
+                    response = {"shard_id": request["shard_id"], "entries": entries}
+                except Exception as e:
+                    response = {"shard_id": request["shard_id"], "error": str(e)}
+                await send_message(writer, response)
+        finally:
+            writer.close()
+
+    host, port = parse_address(address)
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Shard worker listening on {address}")
+    async with server:
+        await server.serve_forever()
+
+
+# A class for splitting files into shards and dispatching them to shard workers
+class ShardCoordinator:
+    def __init__(self, addresses: List[str], shard_count: int = None, retries: int = default_shard_retries,
+                 timeout: float = default_shard_timeout, verbose: bool = False):
+        # The HOST:PORT addresses of the shard workers
+        self.addresses = addresses
+        # The amount of shards to split files into, several per worker by default so that work stays balanced
+        self.shard_count = shard_count if shard_count else len(addresses) * 4
+        # How many times a shard (or a worker) may fail before giving up on it
+        self.retries = retries
+        # How many seconds a single shard may take before it's treated as failed, so a hung worker can't stall the run
+        self.timeout = timeout
+        self.verbose = verbose
+
+    # Split files into shards by the hash of their name, so the same file always lands in the same shard
+    def partition(self, files: List[str]) -> Dict[int, List[str]]:
+        shards = {}
+        for file in files:
+            shard_id = int(md5(file.encode("utf-8")).hexdigest(), 16) % self.shard_count
+            shards.setdefault(shard_id, []).append(file)
+        return shards
+
+    # Hash the given files on the shard workers, calling on_result with the shard id and hashed image entries once
+    # for every shard
+    async def dispatch(self, files: List[str], method: str, reduced_size_factor: int, orientation_invariant: bool,
+                       avoid_db: bool, on_result: Callable[[int, List[Dict[str, any]]], None]) -> None:
+        shards = self.partition(files)
+        if not shards:
+            return
+
+        queue = asyncio.Queue()
+        for shard_id in shards:
+            queue.put_nowait((shard_id, 0))
+        finished = set()
+
+        workers = [asyncio.create_task(self._work(address, queue, shards, finished, method, reduced_size_factor,
+                                                  orientation_invariant, avoid_db, on_result))
+                   for address in self.addresses]
+        joined = asyncio.create_task(queue.join())
+        try:
+            # Wait until every shard is finished, or until there are no workers left to finish them
+            while not joined.done():
+                done, _ = await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is not joined:
+                        # Raises if the worker failed because a shard ran out of retries
+                        task.result()
+                        workers.remove(task)
+                if not workers and not joined.done():
+                    raise Exception("All shard workers failed")
+        finally:
+            for task in [joined, *workers]:
+                task.cancel()
+
+    # Take shards off the queue and send them to a single worker until the worker fails too many times in a row
+    async def _work(self, address: str, queue: asyncio.Queue, shards: Dict[int, List[str]], finished: set,
+                    method: str, reduced_size_factor: int, orientation_invariant: bool, avoid_db: bool,
+                    on_result: Callable[[int, List[Dict[str, any]]], None]) -> None:
+        failures = 0
+        while True:
+            shard_id, attempts = await queue.get()
+            try:
+                entries = await asyncio.wait_for(self._send_shard(address, shard_id, shards[shard_id], method,
+                                                                  reduced_size_factor, orientation_invariant, avoid_db),
+                                                 self.timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ShardError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    e = f"no response within {self.timeout} seconds"
+                print(f"Shard {shard_id} failed on worker {address}: {e}")
+                # The shard is never marked done when giving up, so dispatch sees the failure instead of a finished queue
+                if attempts >= self.retries:
+                    raise Exception(f"Shard {shard_id} failed {attempts + 1} times, giving up")
+                # Put the shard back before marking this attempt done, otherwise the queue could look finished (and
+                # dispatch could stop) while the retry is still pending
+                queue.put_nowait((shard_id, attempts + 1))
+                queue.task_done()
+                failures += 1
+                if failures > self.retries:
+                    print(f"Giving up on worker {address}")
+                    return
+                # Let any idle worker take the retry first, otherwise this worker would take it straight back
+                await asyncio.sleep(0)
+                continue
+
+            failures = 0
+            # Results are only merged once per shard, so retries can never merge a shard twice
+            if shard_id not in finished:
+                finished.add(shard_id)
+                on_result(shard_id, entries)
+            queue.task_done()
+
+    async def _send_shard(self, address: str, shard_id: int, files: List[str], method: str, reduced_size_factor: int,
+                          orientation_invariant: bool, avoid_db: bool) -> List[Dict[str, any]]:
+        host, port = parse_address(address)
+        if self.verbose:
+            print(f"Sending shard {shard_id} ({len(files)} files) to worker {address}")
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await send_message(writer, {"shard_id": shard_id, "files": files, "method": method,
+                                        "reduced_size_factor": reduced_size_factor,
+                                        "orientation_invariant": orientation_invariant, "avoid_db": avoid_db})
+            response = await read_message(reader)
+        finally:
+            writer.close()
+
+        if "error" in response:
+            raise ShardError(response["error"])
+        return response["entries"]
@@ -1,14 +1,22 @@
 from db.database_image_handler import DatabaseImageHandler
 from hashlib import md5
+from io import BytesIO
 from math import sqrt, cos, pi
 from PIL import Image
-from os import mkdir, path, rename
+from os import path
 from random import randrange
-from typing import List
+from typing import Dict, List, Tuple
 
 
 class ImageWorker:
-    def __init__(self, working_dir: str, file: str, reduced_size_factor: int, avoid_db: bool):
+    # Whether or not images handled by this kind of worker can be moved into group folders
+    movable = True
+    # How much larger a floating point pixel must be than its neighbour to count as larger in the difference hash
+    # variants, well above float rounding but below a single pixel value
+    difference_tolerance = 1e-3
+
+    def __init__(self, working_dir: str, file: str, reduced_size_factor: int, avoid_db: bool,
+                 orientation_invariant: bool = False, data: bytes = None):
         # Set size and calculation values
 
         # The factor we're reducing the compressed image by
@@ -20,6 +28,8 @@ class ImageWorker:
         self.d_hash_width = self.p_hash_resize + 1
         # Whether or not to avoid db interactions
         self.avoid_db = avoid_db
+        # Whether or not mirrored and rotated copies of an image should be considered alike
+        self.orientation_invariant = orientation_invariant
 
         # Set values that will be provided or calculated in construct()
 
@@ -27,8 +37,13 @@ class ImageWorker:
         self.name = file
         # The working directory
         self.working_dir = working_dir
+        # The raw bytes of the image file if they were already read, released once the image is decoded
+        self.data = data
         # The PIL Image object
         self.image = None
+        # The dimensions of the image, kept separately so the image itself can be released once hashed
+        self.width = None
+        self.height = None
         self.md5 = None
         # Whether or not this should be verbose
         self.verbose = None
@@ -55,6 +70,9 @@ class ImageWorker:
         self.image_ignore = []
         # A list of hashes for images with different sizes
         self.hashes = []
+        # The hashes of all 8 mirrored and rotated orientations of this image (for the hash method), the first one being
+        # the original orientation. Only calculated if orientation_invariant is set
+        self.variants = []
 
         # A list of workers with exact matches
         self.exact = []
@@ -68,14 +86,11 @@ class ImageWorker:
 
         # Mark this object as initialized
         self.initialized = True
-        # Determine if the given file exists and is a file
-        if not path.exists(self.working_dir + self.name):
-            raise Exception(f"Image {self.name} not found")
-        if not path.isfile(self.working_dir + self.name):
-            raise Exception(f"Image {self.name} is not a file")
 
         # Open this image and convert to a grayscale image
-        self.image = Image.open(self.working_dir + self.name).convert("L")
+        self.image = self.load_image().convert("L")
+        self.width = self.image.width
+        self.height = self.image.height
         # Create an md5 object and calculate the image data hash
         md5_calc = md5()
         md5_calc.update(str(list(self.image.getdata())).encode("utf-8"))
@@ -123,16 +138,82 @@ class ImageWorker:
             if self.image_ignore is None:
                 self.image_ignore = []
 
+        # Hashes loaded from the database don't include the other orientations, so calculate them while the image is
+        # still available
+        if self.orientation_invariant and not self.variants:
+            self.variants = self.hash_variants(self.method)
+
+        return self
+
+    # Open the image file this worker is responsible for, decoding it from memory if it was already read
+    def load_image(self) -> Image.Image:
+        if self.data is not None:
+            image = Image.open(BytesIO(self.data))
+            image.load()
+            self.data = None
+            return image
+
+        # Determine if the given file exists and is a file
+        if not path.exists(self.working_dir + self.name):
+            raise Exception(f"Image {self.name} not found")
+        if not path.isfile(self.working_dir + self.name):
+            raise Exception(f"Image {self.name} is not a file")
+
+        return Image.open(self.working_dir + self.name)
+
+    # Restore this worker from previously calculated hash information instead of decoding the image again
+    def restore(self, entry: Dict[str, any], method: str, db_path: str, verbose: bool = False) -> 'ImageWorker':
+        self.db_path = db_path
+        self.verbose = verbose
+        self.initialized = True
+
+        self.md5 = entry["md5"]
+        self.width = entry["width"]
+        self.height = entry["height"]
+        self.a_hash = entry["a_hash"]
+        self.p_hash = entry["p_hash"]
+        self.d_hash = entry["d_hash"]
+        self.variants = entry.get("variants", [])
+        self.alike[self.md5] = self
+        self.method = method
+
+        self.exists = False
+        self.copy = False
+        self.new_hashes = True
+        # If we're not avoiding the database, determine what is already saved for this image
+        if not self.avoid_db:
+            img_handler = DatabaseImageHandler(db_path, verbose)
+            db_img = img_handler.find_image(self.md5)
+            if db_img is not None:
+                self.exists = True
+                self.copy = db_img['name'] != self.name
+                self.new_hashes = self.reduced_size_factor not in img_handler.find_image_hashes(self.md5)
+
+                # Get all ignored images
+                self.image_ignore = img_handler.find_image_ignore(self.md5, self.name)
+                if self.image_ignore is None:
+                    self.image_ignore = []
+
         return self
 
+    # Get the calculated information of this image, which can later be passed to restore()
+    def get_entry(self) -> Dict[str, any]:
+        self.check_init()
+        return {"name": self.name, "md5": self.md5, "width": self.width, "height": self.height,
+                "a_hash": self.a_hash, "p_hash": self.p_hash, "d_hash": self.d_hash, "variants": self.variants}
+
     # Calculate only the given hash
     def calculate_single_hash(self, method: str) -> None:
+        if self.orientation_invariant:
+            self.variants = self.hash_variants(method)
+
+        # The original orientation's perception and average hashes are the same as the regular hashes, so reuse them
         if method == "P" or method == "PERCEPTION":
-            self.p_hash = self.perception_hash()
+            self.p_hash = self.variants[0] if self.variants else self.perception_hash()
         else:
             self.p_hash = None
         if method == "A" or method == "AVERAGE":
-            self.a_hash = self.average_hash()
+            self.a_hash = self.variants[0] if self.variants else self.average_hash()
         else:
             self.a_hash = None
         if method == "D" or method == "DIFFERENCE":
@@ -140,6 +221,33 @@ class ImageWorker:
         else:
             self.d_hash = None
 
+    # Calculate the hashes of all 8 orientations of this image for the given hash method, deriving every orientation from
+    # a single resize (and, for the perception hash, a single DCT)
+    def hash_variants(self, method: str) -> List[str]:
+        self.check_init()
+        if method == "P" or method == "PERCEPTION":
+            return self.perception_hash_variants()
+        if method == "A" or method == "AVERAGE":
+            return self.average_hash_variants()
+        return self.difference_hash_variants()
+
+    # Get all 8 mirrored and rotated versions of a square matrix, starting with the original
+    @staticmethod
+    def dihedral_variants(matrix: List[List[int]]) -> List[List[List[int]]]:
+        variants = []
+        for block in (matrix, [list(column) for column in zip(*matrix)]):
+            for flip_rows in (False, True):
+                rows = block[::-1] if flip_rows else block
+                for flip_columns in (False, True):
+                    variants.append([row[::-1] for row in rows] if flip_columns else rows)
+        return variants
+
+    # Split the pixels of an image into a matrix of rows
+    @staticmethod
+    def to_matrix(image: Image.Image, width: int) -> List[List[int]]:
+        data = list(image.getdata())
+        return [data[width * i:width * (i + 1)] for i in range(len(data) // width)]
+
     # Check if this object has been initialized and throw an exception otherwise
     def check_init(self) -> None:
         if self.initialized is False:
@@ -152,8 +260,10 @@ class ImageWorker:
             pass
         self.exact.append(dup)
 
-    def check_alike(self, images: List['ImageWorker'], precision: int) -> None:
+    # Find the images which are alike this one, returning each found image with its similarity
+    def check_alike(self, images: List['ImageWorker'], precision: int) -> List[Tuple['ImageWorker', int]]:
         self.check_init()
+        matches = []
         for worker in images:
             # If worker is in this worker's list of exact or alike matches, skip
             if worker.md5 == self.md5 or worker.md5 in self.alike:
@@ -165,9 +275,13 @@ class ImageWorker:
             similarity = self.compare(worker, self.method)
             # Determine if they're enough alike
             if similarity <= precision:
-                # If so, combine the workers lists of alike and set each both lists to be the same
+                matches.append((worker, similarity))
+                # If so, combine the workers lists of alike and set the lists of all alike workers to be the same
                 self.alike.update(worker.alike)
-                worker.alike = self.alike
+                for alike_worker in self.alike.values():
+                    alike_worker.alike = self.alike
+
+        return matches
 
     # The average hash algorithm
     # Finds the average value of all pixels and determines if each individual is higher or lower
@@ -178,14 +292,23 @@ class ImageWorker:
         # Get a list of the pixels
         image_data = list(new_image.getdata())
 
+        # Return the hex'd hash
+        return self.create_hash(self.average_bits(image_data))
+
+    # Get a list of the individual bits (1 if the pixel >= average, 0 if <)
+    @staticmethod
+    def average_bits(image_data: List[int]) -> List[int]:
         # Find the average value of the pixels
-        avg = sum(image_data) / self.reduced_size_factor ** 2
+        avg = sum(image_data) / len(image_data)
 
-        # Get a list of the individual bits (1 if the bit >= average, 0 if <)
-        bits = [int(bit >= avg) for bit in image_data]
+        return [int(bit >= avg) for bit in image_data]
 
-        # Return the hex'd hash
-        return self.create_hash(bits)
+    # The average hashes of all 8 orientations of the image
+    def average_hash_variants(self) -> List[str]:
+        self.check_init()
+        new_image = self.image.resize((self.reduced_size_factor, self.reduced_size_factor))
+        return [self.create_hash(self.average_bits([item for row in variant for item in row]))
+                for variant in self.dihedral_variants(self.to_matrix(new_image, self.reduced_size_factor))]
 
     # The perception hash algorithm
     # Runs a DCT on the pixel data and gets the average value of the returned values, then performs an average hash
@@ -196,6 +319,29 @@ class ImageWorker:
         # Perform DCT
         dct = self.discrete_cosine_transform(list(new_image.getdata()))
 
+        # Return the hex'd hash
+        return self.create_hash(self.dct_bits(dct))
+
+    # The perception hashes of all 8 orientations of the image
+    # Mirroring an image only flips the signs of its odd frequency DCT values, and transposing an image transposes its
+    # DCT values, so every orientation can be derived from the DCT of the original
+    def perception_hash_variants(self) -> List[str]:
+        self.check_init()
+        new_image = self.image.resize((self.p_hash_resize, self.p_hash_resize))
+        dct = self.discrete_cosine_transform(list(new_image.getdata()))
+
+        variants = []
+        for block in (dct, [list(column) for column in zip(*dct)]):
+            for flip_rows in (False, True):
+                for flip_columns in (False, True):
+                    variant = [[-item if (flip_rows and i % 2) != (flip_columns and j % 2) else item
+                                for j, item in enumerate(row)] for i, row in enumerate(block)]
+                    variants.append(self.create_hash(self.dct_bits(variant)))
+        return variants
+
+    # Get a list of the individual bits of DCT values (1 if the value >= average, 0 if <)
+    @staticmethod
+    def dct_bits(dct: List[List[float]]) -> List[int]:
         # Get the average value of the returned DCT data
         avg_dct = 0
         for i, row in enumerate(dct):
@@ -206,10 +352,7 @@ class ImageWorker:
         avg_dct /= (len(dct) ** 2 - 1)
 
         # Runs average hash
-        bits = [int(bit >= avg_dct) for row in dct for bit in row]
-
-        # Return the hex'd hash
-        return self.create_hash(bits)
+        return [int(bit >= avg_dct) for row in dct for bit in row]
 
     # Algorithm idea from
     # https://www.geeksforgeeks.org/discrete-cosine-transform-algorithm-program/
@@ -269,20 +412,39 @@ class ImageWorker:
         for i in range(self.p_hash_resize):
             matrix.append(decomposed_matrix[self.d_hash_width * i:self.d_hash_width * (i + 1)])
 
-        # Calculate the difference between this pixel and the previous pixel (not counting the first row)
+        return self.create_hash(self.difference_bits(matrix))
+
+    # The difference hashes of all 8 orientations of the image
+    # The difference hash isn't square, so a square image is rotated and only the rows the hash needs are used
+    # Resizing a rotated image runs the horizontal and vertical passes in the opposite order, and rounding to whole pixel
+    # values between them flips the bits of nearly equal neighbours. So the image is resized with floating point pixels
+    # instead, and differences within difference_tolerance count as equal to ignore the remaining rounding
+    def difference_hash_variants(self) -> List[str]:
+        self.check_init()
+        new_image = self.image.convert("F").resize((self.d_hash_width, self.d_hash_width))
+        return [self.create_hash(self.difference_bits(variant[:self.p_hash_resize], self.difference_tolerance))
+                for variant in self.dihedral_variants(self.to_matrix(new_image, self.d_hash_width))]
+
+    # Calculate the difference between each pixel and the previous pixel in its row (not counting the first column)
+    # A pixel only counts as larger if it's larger by more than the tolerance
+    @staticmethod
+    def difference_bits(matrix: List[List[float]], tolerance: float = 0) -> List[int]:
         bits = []
         for i in range(len(matrix)):
             for j in range(1, len(matrix[i])):
-                bits.append(int(matrix[i][j] > matrix[i][j - 1]))
+                bits.append(int(matrix[i][j] > matrix[i][j - 1] + tolerance))
 
-        return self.create_hash(bits)
+        return bits
 
     # Compare two different hashes and return the Hamming distance
     def compare(self, other_image: 'ImageWorker', method: str = "P") -> int:
         self.check_init()
-        if method == "P" or "PERCEPTION":
+        # If both images have their orientations calculated, use the closest orientation of this image
+        if self.variants and other_image.variants:
+            value = min(self.hamming_distance(variant, other_image.variants[0]) for variant in self.variants)
+        elif method == "P" or method == "PERCEPTION":
             value = self._compare_p_hash(other_image)
-        elif method == "A" or "AVERAGE":
+        elif method == "A" or method == "AVERAGE":
             value = self._compare_a_hash(other_image)
         else:
             value = self._compare_d_hash(other_image)
@@ -312,9 +474,9 @@ class ImageWorker:
         if hash_b is None:
             print("Other image has no hash")
             return 256
-        # Make sure the hash lengths are the same
-        if len(hash_a) != len(hash_b):
-            raise Exception(f"Hash lengths were not the same, a: {len(hash_a)} b: {len(hash_b)}")
+        # Hashes drop their leading zeros, so pad the shorter hash before comparing
+        hash_a = hash_a[2:].zfill(len(hash_b) - 2)
+        hash_b = hash_b[2:].zfill(len(hash_a))
         distance = 0
         # Loop through each value and increment the distance by 1 if the characters don't match
         for i in range(len(hash_a)):
@@ -337,35 +499,32 @@ class ImageWorker:
             print(f"Hash value [{self.working_dir}{self.name}]: {hex_val}")
         return hex_val
 
-    # Move this image into the provided directory (the directory should not exist)
-    def move(self, new_path: str) -> None:
+    # Determine if this image and all of its exact copies can be moved
+    def is_movable(self) -> bool:
+        return self.movable and all(exact_image.movable for exact_image in self.exact)
+
+    # Get the list of (source, destination) moves needed to move this image into the provided directory
+    # (the directory should not exist yet, it is created when the moves are performed)
+    # The files aren't checked here since checking costs a round trip per file on network file systems, and the moves
+    # fail anyways if the files are missing
+    def plan_move(self, new_path: str) -> List[Tuple[str, str]]:
         self.check_init()
         curr_path = path.join(self.working_dir, self.name)
-        if not path.exists(curr_path):
-            raise Exception(f"Image {self.name} not found before move")
-        if not path.isfile(curr_path):
-            raise Exception(f"Image {self.name} is not a file")
-        if not path.exists(new_path):
-            raise Exception(f"new_path variable {new_path} does not exist")
 
         # Move all exact images into a subdirectory first and then move this image into the same
         if len(self.exact) != 0:
             suffix = hex(randrange(0, 2 ** 10))
             updated_path = path.join(new_path, suffix)
-            mkdir(updated_path)
 
             # Move exact images
-            for exact_image in self.exact:
-                rename(path.join(exact_image.working_dir, exact_image.name),
-                       path.join(updated_path, exact_image.name))
+            moves = [(path.join(exact_image.working_dir, exact_image.name), path.join(updated_path, exact_image.name))
+                     for exact_image in self.exact]
 
             # Move this image
-            rename(path.join(self.working_dir, self.name),
-                   path.join(updated_path, self.name))
+            moves.append((curr_path, path.join(updated_path, self.name)))
+            return moves
         # If there are no exact matches, then just move this image into the new_path
-        else:
-            rename(path.join(self.working_dir, self.name),
-                   path.join(new_path, self.name))
+        return [(curr_path, path.join(new_path, self.name))]
 
     # Finish creating all other hashes before save
     def complete(self) -> None:
@@ -391,10 +550,14 @@ class ImageWorker:
         # Save the new item or the new hashes depending on whether or not the image exists in the database
         image_handler = DatabaseImageHandler(self.db_path, self.verbose)
         if not self.exists:
-            image_handler.save_image(self.md5, self.name, self.image.width, self.image.height)
+            image_handler.save_image(self.md5, self.name, self.width, self.height)
         if self.new_hashes:
             image_handler.save_image_hash(self.md5, self.a_hash, self.d_hash, self.p_hash, self.reduced_size_factor)
 
+        # Mark this image as saved so it isn't saved again
+        self.exists = True
+        self.new_hashes = False
+
     # Save an ignore_similarity request to the database
     def save_ignore_similarity(self, other):
         self.check_init()
@@ -0,0 +1,57 @@
+from image_worker import ImageWorker
+import json
+from os import path
+import sys
+from typing import Dict, List
+
+
+# A class for writing results as JSON Lines while a run progresses, to a file or to stdout (with a path of "-")
+# Matches are written as soon as they are found. Groups are written once they are final, meaning no image which is
+# still to be processed can join them
+class ResultStream:
+    def __init__(self, output_path: str, method: str):
+        # Whether or not results are written to stdout, in which case everything else should be printed elsewhere
+        self.to_stdout = output_path == "-"
+        # Results go to the real stdout, since everything else is printed to stderr in its place while streaming there
+        self.file = sys.__stdout__ if self.to_stdout else open(output_path, "w")
+        # The hash method the results were found with
+        self.method = method
+
+    # Write a pair of exact (distance 0 with the same MD5) or similar images
+    def emit_match(self, image_a: ImageWorker, image_b: ImageWorker, distance: int) -> None:
+        self._write({"event": "duplicate" if image_a.md5 == image_b.md5 else "near_duplicate",
+                     "method": self.method,
+                     "md5": [image_a.md5, image_b.md5],
+                     "paths": [self._path(image_a), self._path(image_b)],
+                     "distance": distance,
+                     "final": False})
+
+    # Write a pair of similar images known only by their MD5s, such as pairs found by an ExternalHashJoin
+    def emit_pair(self, md5_a: str, md5_b: str, distance: int) -> None:
+        self._write({"event": "duplicate" if md5_a == md5_b else "near_duplicate",
+                     "method": self.method,
+                     "md5": [md5_a, md5_b],
+                     "distance": distance,
+                     "final": False})
+
+    # Write a finished group of similar images, each member including the paths of its exact copies
+    def emit_group(self, group: List[ImageWorker]) -> None:
+        self._write({"event": "group",
+                     "method": self.method,
+                     "members": [{"md5": image.md5,
+                                  "paths": [self._path(image)] + [self._path(exact) for exact in image.exact]}
+                                 for image in group],
+                     "final": True})
+
+    def close(self) -> None:
+        if not self.to_stdout:
+            self.file.close()
+
+    @staticmethod
+    def _path(image: ImageWorker) -> str:
+        return path.join(image.working_dir, image.name)
+
+    def _write(self, event: Dict[str, any]) -> None:
+        self.file.write(json.dumps(event) + "\n")
+        # Flush every event so that readers see results right away
+        self.file.flush()
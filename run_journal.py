@@ -0,0 +1,112 @@
+import json
+from os import fsync, path, remove
+from typing import Dict, List, Tuple
+
+default_journal_path = "./run_journal.jsonl"
+
+
+# A class for recording the progress of a run so that an interrupted run can be resumed
+# The journal is a JSON Lines file, with a header describing the run followed by one record per finished file or move
+class RunJournal:
+    def __init__(self, journal_path: str, working_dir: str, method: str, reduced_size_factor: int,
+                 avoid_db: bool = False, orientation_invariant: bool = False):
+        # The path to the journal file
+        self.journal_path = journal_path
+        # The settings of the run, a journal is only resumed if these match
+        # Whether the database was avoided is included since files finished without it were never saved to the database,
+        # and restoring them as if they were would try to save images that were never decoded.
+        # Orientation invariance is included since the orientation variants are only recorded when it's enabled
+        self.header = {"type": "run", "working_dir": path.abspath(working_dir), "method": method,
+                       "reduced_size_factor": reduced_size_factor, "avoid_db": avoid_db,
+                       "orientation_invariant": orientation_invariant}
+        # A dictionary of file names to the hash information of files that have been finished
+        self.done = {}
+        # A list of (source, destination) moves that were planned
+        self.moves = []
+        # A set of moves that have been completed
+        self.moved = set()
+        # How the planned moves are performed (see file_relocator.link_modes)
+        self.link_mode = "move"
+        # The open journal file
+        self.file = None
+
+    # Load an existing journal, returning whether or not it belongs to a run with the same settings
+    # If match_settings is not set, any journal for the same working dir is loaded
+    def load(self, match_settings: bool = True) -> bool:
+        if not path.isfile(self.journal_path):
+            return False
+
+        with open(self.journal_path, "r") as journal_file:
+            lines = journal_file.readlines()
+        records = []
+        for line in lines:
+            # The last line may be cut off if the run crashed while writing it, so just ignore anything unreadable
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+        if not records or (records[0] != self.header if match_settings
+                           else records[0]["working_dir"] != self.header["working_dir"]):
+            print("Existing run journal does not match the current run, starting over")
+            return False
+
+        for record in records[1:]:
+            if record["type"] == "done":
+                self.done[record["name"]] = record
+            elif record["type"] == "moves":
+                self.moves.extend((move[0], move[1]) for move in record["moves"])
+                self.link_mode = record.get("link_mode", "move")
+            elif record["type"] == "moved":
+                self.moved.add((record["move"][0], record["move"][1]))
+
+        self.file = open(self.journal_path, "a")
+        return True
+
+    # Start a new journal, overwriting any existing one
+    def start(self) -> None:
+        self.file = open(self.journal_path, "w")
+        self._write(self.header)
+        self.sync()
+
+    # Record a list of finished files
+    def record_done(self, entries: List[Dict[str, any]]) -> None:
+        for entry in entries:
+            record = dict(entry, type="done")
+            self.done[record["name"]] = record
+            self._write(record)
+        self.sync()
+
+    # Record the full list of moves before any of them are performed
+    def record_moves(self, moves: List[Tuple[str, str]], link_mode: str = "move") -> None:
+        self.moves.extend(moves)
+        self.link_mode = link_mode
+        self._write({"type": "moves", "moves": moves, "link_mode": link_mode})
+        self.sync()
+
+    # Record that a single move was completed
+    # The record is only buffered, call sync to write it out. A move which is done but never recorded is safe to redo
+    # (an existing destination counts as done) and to roll back (every planned move is checked)
+    def record_moved(self, move: Tuple[str, str]) -> None:
+        self.moved.add(move)
+        self._write({"type": "moved", "move": move})
+
+    # Get the moves which were planned but not yet completed
+    def pending_moves(self) -> List[Tuple[str, str]]:
+        return [move for move in self.moves if move not in self.moved]
+
+    # Close and remove the journal once the run has successfully finished
+    def finish(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if path.isfile(self.journal_path):
+            remove(self.journal_path)
+
+    # Make sure everything written so far actually makes it to disk
+    def sync(self) -> None:
+        self.file.flush()
+        fsync(self.file.fileno())
+
+    def _write(self, record: Dict[str, any]) -> None:
+        self.file.write(json.dumps(record) + "\n")
@@ -1,8 +1,15 @@
 import argparse
 import asyncio
-from db import image_database_setup as db_setup
+import sys
+from db import database_export, image_database_setup as db_setup
 from db.database_worker import default_path as default_database_path
-from image_load_orchastrator import ImageLoadOrchastrator, default_working_dir
+from external_join import ExternalHashJoin, default_memory_limit_mb
+from file_relocator import FileRelocator, default_relocation_threads, link_modes
+from image_prefetcher import ImagePrefetcher, default_prefetch_mb, default_prefetch_threads
+from image_shards import ShardCoordinator, default_shard_retries, default_shard_timeout, serve_shards
+from image_load_orchastrator import ImageLoadOrchastrator, default_working_dir, default_checkpoint_size
+from result_stream import ResultStream
+from run_journal import default_journal_path
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="An image similarity checker.")
@@ -19,17 +26,70 @@ if __name__ == "__main__":
     parser.add_argument("--reduced-size-factor", "-s", default=8, type=int,
                         help="How much to reduce the image by when"
                              " creating hash (a higher number will be more precise, but slower)")
+    parser.add_argument("--orientation-invariant", "-o", action="store_true",
+                        help="Also consider mirrored and 90 degree rotated copies of an image alike")
     parser.add_argument("--avoid-db", action="store_true", help="Do not use a db to check if images exist and "
                                                                 "don't save images to db")
     parser.add_argument("--drop-db", action="store_true", help="Drop database. Only this command will be run")
     parser.add_argument("--no-migrate", action="store_true",
                         help="Migrations will not be performed if this flag is passed")
+    parser.add_argument("--export", metavar="PATH",
+                        help="Export the image store into a compressed .npz file. Only this command will be run")
+    parser.add_argument("--import", metavar="PATH", dest="import_path",
+                        help="Merge an export created with --export into the image store. Only this command will be "
+                             "run")
     parser.add_argument("--ignore-similarity", "-i", metavar="IMAGE_1_filename IMAGE_2_filename",
                         help="Add the two provided images to a list which considers them different images no matter"
                              "the similarity. Only this command will be run. Files must be in the same working dir",
                         nargs=2)
+    parser.add_argument("--checkpoint-size", metavar="COUNT", default=default_checkpoint_size, type=int,
+                        help="The amount of images to hash before saving progress to the db and the run journal")
+    parser.add_argument("--journal-path", metavar="PATH", default=default_journal_path,
+                        help="The path to the run journal used to resume interrupted runs")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted run from the run journal instead of starting over")
+    parser.add_argument("--prefetch-threads", metavar="COUNT", default=default_prefetch_threads, type=int,
+                        help="The amount of threads reading image files ahead of decoding (0 to read each file when "
+                             "it's decoded)")
+    parser.add_argument("--prefetch-mb", metavar="MB", default=default_prefetch_mb, type=int,
+                        help="The maximum amount of image data read ahead of decoding, in megabytes")
+    parser.add_argument("--link-mode", default="move", choices=link_modes,
+                        help="How grouped images are put into their group folders. report only prints the groups")
+    parser.add_argument("--relocation-threads", metavar="COUNT", default=default_relocation_threads, type=int,
+                        help="The amount of file operations to perform at the same time when relocating images")
+    parser.add_argument("--rollback", action="store_true",
+                        help="Undo the relocated images of an interrupted run using the run journal. Only this command "
+                             "will be run")
+    parser.add_argument("--stream-results", metavar="PATH",
+                        help="Write matches and groups as JSON Lines to the given file (or - for stdout) as soon as "
+                             "they are found")
+    parser.add_argument("--external-join", action="store_true",
+                        help="Find all similar pairs among the hashes in the db with an out-of-core join, writing them "
+                             "to --stream-results. Only this command will be run")
+    parser.add_argument("--memory-limit", metavar="MB", default=default_memory_limit_mb, type=int,
+                        help="The amount of memory the external join may use, in megabytes")
+    parser.add_argument("--join-temp-dir", metavar="PATH",
+                        help="The directory the external join spills partitions to (the system default if not set)")
+    parser.add_argument("--shard-worker", metavar="HOST:PORT",
+                        help="Run as a shard worker, hashing images from the working dir for a coordinator. Only this "
+                             "command will be run")
+    parser.add_argument("--shard-workers", metavar="HOST:PORT", nargs="+",
+                        help="Hash images on the given shard workers instead of locally")
+    parser.add_argument("--shard-count", metavar="COUNT", type=int,
+                        help="The amount of shards to split images into (default is 4 per shard worker)")
+    parser.add_argument("--shard-retries", metavar="COUNT", default=default_shard_retries, type=int,
+                        help="How many times a failed shard is retried before giving up")
+    parser.add_argument("--shard-timeout", metavar="SECONDS", default=default_shard_timeout, type=float,
+                        help="How long a shard worker may take to hash a shard before the shard is retried")
     parser.add_argument("--verbose", "-v", action="store_true", help="Display calculated image hashes and diff values")
     args = parser.parse_args()
+    if args.external_join and not args.stream_results:
+        parser.error("--external-join requires --stream-results")
+
+    # Keep stdout free for results if they are streamed there, printing everything else to stderr
+    # The stream itself is only opened by the commands which write results, so others leave an existing file alone
+    if args.stream_results == "-":
+        sys.stdout = sys.stderr
 
     # Drop database and then exit the program
     if args.drop_db:
@@ -40,13 +100,52 @@ if __name__ == "__main__":
         if not args.avoid_db and not args.no_migrate:
             db_setup.check_db_version(args.db_path, args.verbose)
 
+        # Export or import the image store and then exit the program
+        if args.export:
+            database_export.export_db(args.db_path, args.export, args.verbose)
+            sys.exit()
+        if args.import_path:
+            database_export.import_db(args.db_path, args.import_path, args.verbose)
+            sys.exit()
+
+        # Join the hashes in the db and then exit the program
+        if args.external_join:
+            join = ExternalHashJoin(args.db_path, args.precision, args.memory_limit * 2 ** 20, args.join_temp_dir,
+                                    args.verbose)
+            stream = ResultStream(args.stream_results, args.comparison_method)
+            join.run(args.comparison_method, args.reduced_size_factor, stream)
+            stream.close()
+            sys.exit()
+
+        prefetcher = None
+        if args.prefetch_threads > 0:
+            prefetcher = ImagePrefetcher(args.prefetch_threads, args.prefetch_mb * 2 ** 20, args.verbose)
+
         # Get a singleton instance of the ImageLoadOrchastrator
         orc = ImageLoadOrchastrator.get_instance(args.image_working_dir, args.db_path, args.verbose,
-                                                 args.precision, args.reduced_size_factor)
+                                                 args.precision, args.reduced_size_factor, args.checkpoint_size,
+                                                 args.journal_path, args.orientation_invariant, prefetcher)
+
+        relocator = FileRelocator(args.link_mode, args.relocation_threads, args.verbose)
 
         # If we're only trying to add images to the ignore list, do that
         if args.ignore_similarity:
             orc.ignore_similarity(args.ignore_similarity[0], args.ignore_similarity[1])
+        # If we're only trying to undo an interrupted relocation, do that
+        elif args.rollback:
+            orc.rollback(relocator)
+        # If we're a shard worker, serve hashing requests until stopped
+        elif args.shard_worker:
+            asyncio.run(serve_shards(args.shard_worker, orc))
         # Otherwise, load images and find similar results asynchronously
         else:
-            asyncio.run(orc.run(args.comparison_method, args.avoid_db))
+            coordinator = None
+            if args.shard_workers:
+                coordinator = ShardCoordinator(args.shard_workers, args.shard_count, args.shard_retries,
+                                               args.shard_timeout, args.verbose)
+            stream = None
+            if args.stream_results:
+                stream = ResultStream(args.stream_results, args.comparison_method)
+            asyncio.run(orc.run(args.comparison_method, args.avoid_db, args.resume, coordinator, relocator, stream))
+            if stream is not None:
+                stream.close()
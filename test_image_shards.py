@@ -0,0 +1,73 @@
+import asyncio
+from image_shards import ShardCoordinator, ShardError
+import unittest
+
+
+# A coordinator whose shard workers are faked, failing the chosen shards a set amount of times before succeeding
+class FlakyCoordinator(ShardCoordinator):
+    def __init__(self, addresses, shard_count, failures, retries=3, hangs=None, hung_addresses=()):
+        super().__init__(addresses, shard_count, retries, timeout=0.1)
+        # Shard ids mapped to how many more times they fail
+        self.failures = failures
+        # Shard ids mapped to how many more times they never get a response
+        self.hangs = hangs or {}
+        # Workers which never respond at all
+        self.hung_addresses = hung_addresses
+
+    async def _send_shard(self, address, shard_id, files, method, reduced_size_factor, orientation_invariant, avoid_db):
+        # Take a moment, as a real round trip would, so a retry is still in flight when the other shards finish
+        await asyncio.sleep(0.01)
+        if address in self.hung_addresses:
+            await asyncio.sleep(60)
+        if self.hangs.get(shard_id, 0) > 0:
+            self.hangs[shard_id] -= 1
+            await asyncio.sleep(60)
+        if self.failures.get(shard_id, 0) > 0:
+            self.failures[shard_id] -= 1
+            raise ShardError(f"shard {shard_id} failed")
+        return [{"name": file} for file in files]
+
+
+class ShardCoordinatorTest(unittest.TestCase):
+    def dispatch(self, coordinator, files):
+        results = {}
+        asyncio.run(coordinator.dispatch(files, "P", 1, False, False,
+                                         lambda shard_id, entries: results.update({shard_id: entries})))
+        return results
+
+    def test_final_shard_failing_once_is_still_merged(self):
+        coordinator = FlakyCoordinator(["worker:1"], 1, {0: 1})
+        files = [f"{i}.jpg" for i in range(5)]
+        results = self.dispatch(coordinator, files)
+        self.assertEqual({0: [{"name": file} for file in files]}, results)
+
+    def test_last_of_several_shards_failing_once_is_still_merged(self):
+        files = [f"{i}.jpg" for i in range(50)]
+        shards = ShardCoordinator(["worker:1"], 4).partition(files)
+        last_shard = list(shards)[-1]
+        coordinator = FlakyCoordinator(["worker:1", "worker:2"], 4, {last_shard: 1})
+        results = self.dispatch(coordinator, files)
+        self.assertEqual(sorted(shards), sorted(results))
+        self.assertEqual(sorted(files), sorted(entry["name"] for entries in results.values() for entry in entries))
+
+    def test_hung_shard_times_out_and_is_retried(self):
+        coordinator = FlakyCoordinator(["worker:1", "worker:2"], 2, {}, hangs={0: 1, 1: 1})
+        files = [f"{i}.jpg" for i in range(20)]
+        results = self.dispatch(coordinator, files)
+        self.assertEqual({0: 0, 1: 0}, coordinator.hangs)
+        self.assertEqual(sorted(files), sorted(entry["name"] for entries in results.values() for entry in entries))
+
+    def test_shards_of_a_hung_worker_are_retried_on_another(self):
+        coordinator = FlakyCoordinator(["worker:1", "worker:2"], 8, {}, hung_addresses=["worker:1"])
+        files = [f"{i}.jpg" for i in range(40)]
+        results = self.dispatch(coordinator, files)
+        self.assertEqual(sorted(files), sorted(entry["name"] for entries in results.values() for entry in entries))
+
+    def test_shard_out_of_retries_fails_dispatch(self):
+        coordinator = FlakyCoordinator(["worker:1"], 1, {0: 10}, retries=2)
+        with self.assertRaises(Exception):
+            self.dispatch(coordinator, ["a.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()